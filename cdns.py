@@ -5,32 +5,77 @@
 # https://github.com/ninjamar/compactdns
 
 import argparse
+import asyncio
 import concurrent.futures
 import dataclasses
 import fnmatch
+import functools
+import heapq
+import itertools
 import logging
+import os
+import queue
+import re
+import secrets
 import socket
 import struct
+import sys
 import threading
 import time
 
 # TODO: Make sure cache is better
 # TODO: Ensure all code is right (via tests)
 # TODO: Document the archictecture (comments)
-# TODO: Add timeout
 # TODO: Load configuration from file
 # TODO: Type annotations
 # TODO: Handle builtins for classes
 
+# Precompiled struct formats, so the format string isn't parsed on every packet
+# https://docs.python.org/3/library/struct.html#struct.Struct
+_HDR = struct.Struct("!HHHHHH")  # Header: id, flags, qdcount, ancount, nscount, arcount
+_QFIX = struct.Struct("!HH")  # Question: type, class
+_AFIX = struct.Struct("!HHIH")  # Answer: type, class, ttl, rdlength
+_U16 = struct.Struct("!H")  # Big endian unsigned short, 2 bytes
+
 
 class TimedCache:
     """Basically a dictionary but except the keys expire after some time"""
 
-    def __init__(self):
-        """Create a TimedCache instance"""
+    def __init__(self, max_size: int = 4096):
+        """Create a TimedCache instance
+
+        :param max_size: maximum number of keys, defaults to 4096
+        :type max_size: int
+        """
         self.data = {}
+        self.max_size = max_size
+
+        # Heap of (expiry, counter, key), so the next key to expire is always first
+        # The counter breaks ties, since keys don't have to be orderable
+        self.heap = []
+        self.counter = itertools.count()
+        # Worker threads share the cache, so lock changes to the heap
+        self.lock = threading.Lock()
+
+    def evict(self, now: float):
+        """Remove all keys that have expired
 
-    def set(self, key, value, ttl):
+        :param now: current time
+        :type now: float
+        """
+        with self.lock:
+            while self.heap and self.heap[0][0] < now:
+                self._pop()
+
+    def _pop(self):
+        """Pop the key that expires first, if the heap entry is still current"""
+        expiry, _, key = heapq.heappop(self.heap)
+        entry = self.data.get(key)
+        # The key might have been set again since this entry was pushed
+        if entry is not None and entry[1] == expiry:
+            del self.data[key]
+
+    def set(self, key, value, ttl, now: float | None = None):
         """Set a key
 
         :param key: the key to set
@@ -39,24 +84,47 @@ class TimedCache:
         :type value: Any
         :param ttl: duration of key
         :type ttl: int
+        :param now: current time, defaults to time.time()
+        :type now: float | None
         """
-        self.data[key] = (value, time.time() + ttl)
-
-    def get(self, key):
+        if now is None:
+            now = time.time()
+        expiry = now + ttl
+        with self.lock:
+            self.data[key] = (value, expiry)
+            heapq.heappush(self.heap, (expiry, next(self.counter), key))
+        self.evict(now)
+
+        # When full, remove the keys closest to expiring
+        with self.lock:
+            while len(self.data) > self.max_size and self.heap:
+                self._pop()
+
+    def get(self, key, now: float | None = None):
         """Get a timed, key, deleting it if it expires
 
         :param key: the key to get
         :type key: Hashable
+        :param now: current time, defaults to time.time()
+        :type now: float | None
         :return: value for key
         :rtype: _Any
         """
-        if key not in self.data:
+        if now is None:
+            now = time.time()
+        self.evict(now)
+
+        entry = self.data.get(key)
+        if entry is None:
             return None
 
-        value, expiry = self.data[key]
-        if expiry < time.time():
-            # Remove the item
-            del self.data[key]
+        value, expiry = entry
+        if expiry < now:
+            # Remove the item, unless another thread has set it again
+            with self.lock:
+                entry = self.data.get(key)
+                if entry is not None and entry[1] < now:
+                    del self.data[key]
             return None
         return value
 
@@ -74,6 +142,19 @@ class TimedCache:
 def encode_name_uncompressed(name: str) -> bytes:
     """Encode a DNS name, without compression
 
+    :param name: DNS name to encode
+    :type name: str
+    :return: encoded DNS name
+    :rtype: bytes
+    """
+    return _encode_name(name)
+
+
+# The same names are queried over and over, so only encode each one once
+@functools.lru_cache(maxsize=8192)
+def _encode_name(name: str) -> bytes:
+    """Encode a DNS name, without compression (cached)
+
     :param name: DNS name to encode
     :type name: str
     :return: encoded DNS name
@@ -104,28 +185,29 @@ def decode_name_uncompressed(buf: bytes) -> str:
     return ".".join(labels)
 
 
-def decode_name(buf: bytes, start_idx: int) -> str:
+def decode_name(
+    buf: bytes, start_idx: int, decoded: dict[int, tuple[str, int]] | None = None
+) -> tuple[str, int]:
     """Decode a name, that is compressed, from a buffer
 
     :param buf: buffer containing name
-    :type buf: bytes
+    :type buf: bytes | memoryview
     :param start_idx: start index of name
     :type start_idx: int
+    :param decoded: names already decoded from buf, keyed by start index
+    :type decoded: dict[int, tuple[str, int]] | None
     :raises Exception: infinite loop
-    :return: decoded name
-    :rtype: str
+    :return: decoded name and index after it
+    :rtype: tuple[str, int]
     """
+    # Pointers usually reference the same offset repeatedly
+    if decoded is not None and start_idx in decoded:
+        return decoded[start_idx]
+
     labels = []
     idx = start_idx
 
-    # Prevent of going into a loop
-    visited = set()
-
     while True:
-        if idx in visited:
-            raise Exception("Unable to decode domain: loop detected")
-        visited.add(idx)
-
         # Length of section
         length = buf[idx]
         # Null terminator
@@ -134,10 +216,14 @@ def decode_name(buf: bytes, start_idx: int) -> str:
             break
         # Pointer
         elif length & 0xC0 == 0xC0:
-            # Unpack the pointer
-            pointer = struct.unpack("!H", buf[idx : idx + 2])[0] & 0x3FFF
+            # Unpack the pointer (low 6 bits of this byte + the next byte)
+            pointer = ((length & 0x3F) << 8) | buf[idx + 1]
+            # Labels only move forward, so a loop needs a pointer that doesn't go
+            # back before this name
+            if pointer >= start_idx:
+                raise Exception("Unable to decode domain: loop detected")
             # Recursively decode the pointer
-            domain, _ = decode_name(buf, pointer)
+            domain, _ = decode_name(buf, pointer, decoded)
             # Add part to domain
             labels.append(domain)
 
@@ -145,53 +231,69 @@ def decode_name(buf: bytes, start_idx: int) -> str:
             break
         else:
             # Add part to domain
-            labels.append(buf[idx + 1 : idx + 1 + length].decode("ascii"))
+            # Works for both bytes and memoryview (slicing a memoryview doesn't copy)
+            labels.append(str(buf[idx + 1 : idx + 1 + length], "ascii"))
             idx += 1 + length
 
-    return ".".join(labels), idx
+    result = ".".join(labels), idx
+    if decoded is not None:
+        decoded[start_idx] = result
+    return result
+
+
+def _flag(shift: int, mask: int) -> property:
+    """Create a property for a field packed inside DNSHeader.flags
+
+    :param shift: position of the lowest bit of the field
+    :type shift: int
+    :param mask: mask of the field, after shifting
+    :type mask: int
+    :return: property to get and set the field
+    :rtype: property
+    """
+
+    def get(self) -> int:
+        return (self.flags >> shift) & mask
+
+    def set(self, value: int):
+        self.flags = (self.flags & ~(mask << shift)) | ((value & mask) << shift)
 
+    return property(get, set)
 
-@dataclasses.dataclass(unsafe_hash=True)
+
+@dataclasses.dataclass(slots=True)
 class DNSHeader:
     """Dataclass to store DNS header"""
 
     # Required fields
     # https://datatracker.ietf.org/doc/html/rfc1035#section-4.1.1
     id: int = 0
-    qr: int = 0
-    opcode: int = 0
-    aa: int = 0
-    tc: int = 0
-    rd: int = 0
-    ra: int = 0
-    z: int = 0
-    rcode: int = 0
+    # Keep the flags packed, since most headers are passed through unmodified
+    flags: int = 0
     qdcount: int = 0
     ancount: int = 0
     nscount: int = 0
     arcount: int = 0
 
+    # Fields inside flags, computed when accessed
+    qr = _flag(15, 0x1)  # QR: 1 bit at bit 15
+    opcode = _flag(11, 0xF)  # OPCODE: 4 bits at bits 11-14
+    aa = _flag(10, 0x1)  # AA: 1 bit at bit 10
+    tc = _flag(9, 0x1)  # TC: 1 bit at bit 9
+    rd = _flag(8, 0x1)  # RD: 1 bit at bit 8
+    ra = _flag(7, 0x1)  # RA: 1 bit at bit 7
+    z = _flag(4, 0x7)  # Z: 3 bits at bits 4-6
+    rcode = _flag(0, 0xF)  # RCODE: 4 bits at bits 0-3
+
     def pack(self) -> bytes:
         """Pack the DNS header
 
         :return: packed DNS header
         :rtype: bytes
         """
-        flags = (
-            (self.qr << 15)  # QR: 1 bit at bit 15
-            | (self.opcode << 11)  # OPCODE: 4 bits at bits 11-14
-            | (self.aa << 10)  # AA: 1 bit at bit 10
-            | (self.tc << 9)  # TC: 1 bit at bit 9
-            | (self.rd << 8)  # RD: 1 bit at bit 8
-            | (self.ra << 7)  # RA: 1 bit at bit 7
-            | (self.z << 4)  # Z: 3 bits at bits 4-6
-            | (self.rcode)  # RCODE: 4 bits at bits 0-3
-        )
-
-        return struct.pack(
-            "!HHHHHH",
+        return _HDR.pack(
             self.id,
-            flags,
+            self.flags,
             self.qdcount,
             self.ancount,
             self.nscount,
@@ -203,38 +305,16 @@ class DNSHeader:
         """Create a DNSHeader object from a buffer
 
         :param buf: buffer containing a DNS header
-        :type buf: bytes
+        :type buf: bytes | memoryview
         :return: DNS header
         :rtype: DNSHeader
         """
-        unpacked = struct.unpack("!HHHHHH", buf[:12])  # Header is always 12 bytes
-        flags = unpacked[1]
-        qr = (flags >> 15) & 0x1
-        opcode = (flags >> 11) & 0xF
-        aa = (flags >> 10) & 0x1
-        tc = (flags >> 9) & 0x1
-        rd = (flags >> 8) & 0x1
-        ra = (flags >> 7) & 0x1
-        z = (flags >> 4) & 0x7
-        rcode = flags & 0xF
-        return cls(
-            id=unpacked[0],
-            qr=qr,
-            opcode=opcode,
-            aa=aa,
-            tc=tc,
-            rd=rd,
-            ra=ra,
-            z=z,
-            rcode=rcode,
-            qdcount=unpacked[2],
-            ancount=unpacked[3],
-            nscount=unpacked[4],
-            arcount=unpacked[5],
-        )
+        # Header is always 12 bytes
+        # Fields are in the same order as the struct
+        return cls(*_HDR.unpack_from(buf, 0))
 
 
-@dataclasses.dataclass(unsafe_hash=True)
+@dataclasses.dataclass(slots=True, frozen=True)
 class DNSQuestion:
     """Dataclass to store DNS question"""
 
@@ -246,6 +326,24 @@ class DNSQuestion:
     type_: int = 1
     class_: int = 1
 
+    # Questions are used as cache keys, so compute the hash once
+    _hash: int = dataclasses.field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        """Compute the hash of the question"""
+        # Frozen, so the field can't be set normally
+        object.__setattr__(
+            self, "_hash", hash((self.decoded_name, self.type_, self.class_))
+        )
+
+    def __hash__(self) -> int:
+        """Get the precomputed hash of the question
+
+        :return: hash of the question
+        :rtype: int
+        """
+        return self._hash
+
     def pack(self, encoded_name: bytes) -> bytes:
         """Pack the DNS question
 
@@ -255,11 +353,24 @@ class DNSQuestion:
         :rtype: bytes
         """
 
+        out = bytearray()
+        self.write_into(out, encoded_name)
+        return bytes(out)
+
+    def write_into(self, out: bytearray, encoded_name: bytes):
+        """Pack the DNS question onto the end of a buffer
+
+        :param out: buffer to write to
+        :type out: bytearray
+        :param encoded_name: encoded name
+        :type encoded_name: bytes
+        """
         # Require an encoded name, since compression is handled elsewhere
-        return encoded_name + struct.pack("!HH", self.type_, self.class_)
+        out += encoded_name
+        out += _QFIX.pack(self.type_, self.class_)
 
 
-@dataclasses.dataclass(unsafe_hash=True)
+@dataclasses.dataclass(slots=True, frozen=True)
 class DNSAnswer:
     """Dataclass to store DNS answer"""
 
@@ -282,18 +393,27 @@ class DNSAnswer:
         :return: packed DNS answer
         :rtype: bytes
         """
+        out = bytearray()
+        self.write_into(out, encoded_name)
+        return bytes(out)
+
+    def write_into(self, out: bytearray, encoded_name: bytes):
+        """Pack the DNS answer onto the end of a buffer
+
+        :param out: buffer to write to
+        :type out: bytearray
+        :param encoded_name: name encoded
+        :type encoded_name: bytes
+        """
         # Require an encoded name, since compression is handled elsewhere
-        return (
-            encoded_name
-            + struct.pack(
-                "!HHIH",
-                self.type_,
-                self.class_,
-                self.ttl,
-                self.rdlength,
-            )
-            + self.rdata
+        out += encoded_name
+        out += _AFIX.pack(
+            self.type_,
+            self.class_,
+            self.ttl,
+            self.rdlength,
         )
+        out += self.rdata
 
 
 def pack_all_uncompressed(
@@ -312,14 +432,18 @@ def pack_all_uncompressed(
     """
 
     # Pack header
-    response = header.pack()
-    # Pack questions
-    for question in questions:
-        response += question.pack(encode_name_uncompressed(question.decoded_name))
-    # Pack answers
-    for answer in answers:
-        response += answer.pack(encode_name_uncompressed(answer.decoded_name))
-    return response
+    # Use a bytearray, since appending to bytes copies the whole response
+    response = bytearray(header.pack())
+    # Only encode each name once
+    encoded_names = {}
+    # Pack questions + answers
+    for record in (*questions, *answers):
+        encoded_name = encoded_names.get(record.decoded_name)
+        if encoded_name is None:
+            encoded_name = encode_name_uncompressed(record.decoded_name)
+            encoded_names[record.decoded_name] = encoded_name
+        record.write_into(response, encoded_name)
+    return bytes(response)
 
 
 def pack_all_compressed(
@@ -337,40 +461,26 @@ def pack_all_compressed(
     :rtype: bytes
     """
     # Pack header
-    response = header.pack()
-    # Store pointer locations
-    name_offset_map = {}
+    # Use a bytearray, since appending to bytes copies the whole response
+    response = bytearray(header.pack())
+    # Store the pointer for each name that has been written
+    name_pointer_map = {}
 
     # Compress question + answers
     # Pack + store names + compression
-    for question in questions:
-        # If the name is repeated
-        if question.decoded_name in name_offset_map:
-            # Starting pointer + offset of name
-            pointer = 0xC000 | name_offset_map[question.decoded_name]
-
-            encoded_name = struct.pack("!H", pointer)
-        else:
+    for record in (*questions, *answers):
+        # If the name is repeated, use the pointer
+        encoded_name = name_pointer_map.get(record.decoded_name)
+        if encoded_name is None:
             # Otherwise, encode the name without compression
-            encoded_name = encode_name_uncompressed(question.decoded_name)
+            encoded_name = encode_name_uncompressed(record.decoded_name)
             # Store the name for future pointers
-            name_offset_map[question.decoded_name] = len(response)
-
-        response += question.pack(encoded_name)
-
-    for answer in answers:
-        if answer.decoded_name in name_offset_map:
             # Starting pointer + offset of name
-            pointer = 0xC000 | name_offset_map[answer.decoded_name]
+            name_pointer_map[record.decoded_name] = _U16.pack(0xC000 | len(response))
 
-            encoded_name = struct.pack("!H", pointer)
-        else:
-            encoded_name = encode_name_uncompressed(answer.decoded_name)
-            name_offset_map[answer.decoded_name] = len(response)
+        record.write_into(response, encoded_name)
 
-        response += answer.pack(encoded_name)
-
-    return response
+    return bytes(response)
 
 
 def unpack_all(
@@ -387,22 +497,27 @@ def unpack_all(
     :rtype: tuple[DNSHeader, DNSQuestion]
     """
 
+    # Wrap the buffer once, so reading fields and labels doesn't copy
+    mv = memoryview(buf)
+
     # Header isn't compressed
     # Load the first 12 bytes into the header
-    header = DNSHeader.from_buffer(buf[:12])
+    header = DNSHeader.from_buffer(mv)
 
     # Start after the header
     idx = 12
+    # Names decoded in this buffer, keyed by start index
+    decoded = {}
 
     questions = []
 
     # Use header.qdcount for # of questions
     for _ in range(header.qdcount):
         # Decode the name
-        decoded_name, idx = decode_name(buf, idx)
+        decoded_name, idx = decode_name(mv, idx, decoded)
 
         # Unpack the other fields
-        type_, class_ = struct.unpack("!HH", buf[idx : idx + 4])
+        type_, class_ = _QFIX.unpack_from(mv, idx)
         idx += 4
 
         questions.append(
@@ -413,24 +528,14 @@ def unpack_all(
     # use header.ancount for # of answers
     for _ in range(header.ancount):
         # Decode the name
-        decoded_name, idx = decode_name(buf, idx)
+        decoded_name, idx = decode_name(mv, idx, decoded)
 
-        # Decode required fields
-        type_, class_ = struct.unpack("!HH", buf[idx : idx + 4])
-        idx += 4
+        # Decode required fields (type, class, ttl, rdlength) in one call
+        type_, class_, ttl, rdlength = _AFIX.unpack_from(mv, idx)
+        idx += _AFIX.size
 
-        # Struct format
-        # https://docs.python.org/3/library/struct.html
-        # Big indian unsigned int, 4 bytess
-        ttl = struct.unpack("!I", buf[idx : idx + 4])[0]
-        idx += 4
-
-        # Big endian unsigned short, 2 bytes
-        rdlength = struct.unpack("!H", buf[idx : idx + 2])[0]
-        idx += 2
-
-        # Use rdlength to get rdata
-        rdata = buf[idx : idx + rdlength]
+        # Use rdlength to get rdata, only copying it out at the end
+        rdata = bytes(mv[idx : idx + rdlength])
         idx += rdlength
 
         answers.append(
@@ -448,6 +553,60 @@ def unpack_all(
     return (header, questions) if header.ancount == 0 else (header, questions, answers)
 
 
+class DNSProtocol(asyncio.DatagramProtocol):
+    """Receive DNS queries on an event loop, and send back the responses"""
+
+    def __init__(self, manager: "ServerManager", executor: concurrent.futures.Executor):
+        """Create a DNSProtocol instance
+
+        :param manager: server to handle queries with
+        :type manager: ServerManager
+        :param executor: executor to run handle_dns_query on
+        :type executor: concurrent.futures.Executor
+        """
+        self.manager = manager
+        self.executor = executor
+        self.transport = None
+
+    def connection_made(self, transport: asyncio.DatagramTransport):
+        """Store the transport, once the socket is ready
+
+        :param transport: transport for the socket
+        :type transport: asyncio.DatagramTransport
+        """
+        self.transport = transport
+
+    def datagram_received(self, data: bytes, addr: tuple[str, int]):
+        """Handle a DNS query on the executor
+
+        :param data: buffer containing DNS query
+        :type data: bytes
+        :param addr: address + port of client
+        :type addr: tuple[str, int]
+        """
+        future = asyncio.get_running_loop().run_in_executor(
+            self.executor, self.manager.handle_dns_query, data
+        )
+        future.add_done_callback(functools.partial(self.send_response, addr))
+
+    def send_response(self, addr: tuple[str, int], future: asyncio.Future):
+        """Send the response back to the client
+
+        Each transport owns its socket, so no lock is needed.
+
+        :param addr: address + port of client
+        :type addr: tuple[str, int]
+        :param future: future containing the response
+        :type future: asyncio.Future
+        """
+        if future.exception() is not None:
+            # Handle errors, but keep the program running
+            logging.error("Error", exc_info=future.exception())
+            return
+        self.transport.sendto(future.result(), addr)
+        logging.info("Sent response")
+
+
 class ServerManager:
     """A server session"""
 
@@ -459,6 +618,7 @@ class ServerManager:
         blocklist: set[str],
         redirect_ip: str,
         default_blocking_ttl: int = 60,
+        resolver_timeout: float = 5,
     ):
         """Create a ServerManager instance
 
@@ -472,194 +632,438 @@ class ServerManager:
         :type redirect_ip: str
         :param default_blocking_ttl: default ttl for blocked hosts
         :type default_blocking_ttl: int
+        :param resolver_timeout: seconds to wait for the resolver, defaults to 5
+        :type resolver_timeout: float
         """
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.sock.bind(host)
+        self.host = host
+        # Sockets bound to host, created when the server is started
+        self.sock = None
+        self.socks = []
 
         self.resolver_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        # Connecting binds the socket before the receiving thread starts, and makes
+        # the kernel drop datagrams that don't come from the resolver
+        self.resolver_socket.connect(resolver_addr)
         self.resolver_socket_addr = resolver_addr
+        self.resolver_timeout = resolver_timeout
+
+        # All threads share the resolver socket, and a single thread receives the
+        # responses, passing each one to the query with the same transaction ID
+        # transaction ID : queue for response
+        self.pending = {}
+        self.pending_lock = threading.Lock()
+        self.resolver_thread = threading.Thread(
+            target=self.receive_resolver_responses, daemon=True
+        )
+        self.resolver_thread.start()
 
         self.blocklist = blocklist
+        # Exact hosts can be checked with a set lookup
+        self.blocklist_exact = {
+            loc for loc in blocklist if not any(c in loc for c in "*?[")
+        }
+        # Subdomain patterns (*.domain.tld) are checked by looking up each suffix
+        # of the name, starting at a dot (*.domain.tld -> .domain.tld)
+        self.blocklist_suffixes = {
+            loc[1:]
+            for loc in blocklist - self.blocklist_exact
+            if loc.startswith("*.") and not any(c in loc[1:] for c in "*?[")
+        }
+        # Other wildcards get compiled into a single regex, so each name is only
+        # scanned once
+        wildcards = (
+            blocklist
+            - self.blocklist_exact
+            - {"*" + suffix for suffix in self.blocklist_suffixes}
+        )
+        self.blocklist_re = (
+            re.compile("|".join(fnmatch.translate(loc) for loc in wildcards))
+            if wildcards
+            else None
+        )
         self.redirect_ip = redirect_ip
+        # inet_aton encodes a ip address into bytes
+        self.redirect_rdata = socket.inet_aton(redirect_ip)
 
         self.default_blocking_ttl = default_blocking_ttl
 
         self.cache = TimedCache()
         # hostname : answer
 
+        # Answers are immutable, so reuse the fake answer for each blocked question
+        self.blocked_answer = functools.lru_cache(maxsize=4096)(
+            self.make_blocked_answer
+        )
+
+    def make_server_socket(self, reuse_port: bool = False) -> socket.socket:
+        """Create a socket bound to the host address
+
+        :param reuse_port: set SO_REUSEPORT, so several sockets can be bound to the
+            same address, and the kernel load balances datagrams between them
+        :type reuse_port: bool
+        :return: bound socket
+        :rtype: socket.socket
+        """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind(self.host)
+        return sock
+
+    def make_blocked_answer(self, name: str, type_: int, class_: int) -> DNSAnswer:
+        """Create the fake answer for a blocked question
+
+        :param name: decoded name of the question
+        :type name: str
+        :param type_: type of the question
+        :type type_: int
+        :param class_: class of the question
+        :type class_: int
+        :return: answer redirecting to redirect_ip
+        :rtype: DNSAnswer
+        """
+        return DNSAnswer(
+            decoded_name=name,
+            type_=type_,
+            class_=class_,
+            ttl=self.default_blocking_ttl,
+            rdlength=4,
+            rdata=self.redirect_rdata,
+        )
+
+    def is_blocked(self, name: str) -> bool:
+        """Check if a name matches the blocklist
+
+        :param name: decoded name to check
+        :type name: str
+        :return: is the name blocked?
+        :rtype: bool
+        """
+        if name in self.blocklist_exact:
+            return True
+
+        if self.blocklist_suffixes:
+            idx = name.find(".")
+            while idx != -1:
+                if name[idx:] in self.blocklist_suffixes:
+                    return True
+                idx = name.find(".", idx + 1)
+
+        return (
+            self.blocklist_re is not None and self.blocklist_re.match(name) is not None
+        )
+
     def handle_dns_query(self, buf: bytes) -> bytes:
         """Handle a DNS query
 
         :param buf: buffer containing DNS query
-        :type buf: bytes
+        :type buf: bytes | memoryview
         :return: response from server
         :rtype: bytes
         """
         logging.info("Received query")
 
+        # Share one timestamp for every cache operation in this query
+        now = time.time()
+
         # Recieve header and questions
         header, questions = unpack_all(buf)
 
-        logging.debug(f"Received query: {header}, {questions}")
+        logging.debug("Received query: %s, %s", header, questions)
 
         # check cache for all
 
-        # Copy header
-        new_header = dataclasses.replace(header)
         new_questions = []
-        question_index_blocked = []
-        question_index_cached = []
+        # Answers for cached and blocked questions, in the same order as questions
+        # None for questions that are forwarded
+        local_answers = []
 
         # Remove blocked sites, so it doesn't get forwarded
         # Remove cached sites, so it doesn't get forwarded
-        for idx, question in enumerate(questions):
-            if question in self.cache:
-                question_index_cached.append(idx)
+        for question in questions:
+            # Read the cache directly, since this is the most common path
+            entry = self.cache.data.get(question)
+            if entry is not None and entry[1] >= now:
+                local_answers.append(entry[0])
             # Use file matching syntax to detect block
-            elif any(
-                fnmatch.fnmatch(question.decoded_name, loc) for loc in self.blocklist
-            ):
-                question_index_blocked.append(idx)
+            elif self.is_blocked(question.decoded_name):
+                # Fake answer
+                local_answers.append(
+                    self.blocked_answer(
+                        question.decoded_name, question.type_, question.class_
+                    )
+                )
             else:
                 new_questions.append(question)
+                local_answers.append(None)
 
-        # print(question_index_cached)
+        # Nothing to add to the response, so forward the query as is, and send back
+        # the response without repacking it
+        if len(new_questions) == len(questions):
+            try:
+                response = self.forward_dns_query(bytes(buf))
+            except TimeoutError:
+                # Only fail this query, and keep the server running
+                logging.warning("Resolver timed out, sending SERVFAIL")
+                return self.servfail(header, questions)
+
+            logging.debug("Received query from dns server")
+
+            # The response is sent back either way, so failing to cache it is fine
+            try:
+                recv = unpack_all(response)
+                # Sometimes there will be no answers
+                if len(recv) > 2:
+                    self.cache_answers(questions, recv[2], now)
+            except Exception:
+                logging.warning("Unable to cache response", exc_info=1)
+            return response
+
+        # Copy header
+        new_header = dataclasses.replace(header)
         # Set new qdcount for forwarded header
         new_header.qdcount = len(new_questions)
 
-        logging.debug(f"New header {new_header}, new questions {new_questions}")
+        logging.debug("New header %s, new questions %s", new_header, new_questions)
 
         # Only forward query if there is something to forward
         if new_header.qdcount > 0:
             # Process header, questions
             # Repack data
             send = pack_all_compressed(new_header, new_questions)
-            response = self.forward_dns_query(send)
+            try:
+                response = self.forward_dns_query(send)
+            except TimeoutError:
+                # Only fail this query, and keep the server running
+                logging.warning("Resolver timed out, sending SERVFAIL")
+                return self.servfail(header, questions)
 
             logging.debug("Received query from dns server")
 
             # Add the blocked sites to the response
             recv = unpack_all(response)
             recv_header = recv[0]
-            recv_questions = recv[1]
             # Sometimes there will be no answers
             recv_answers = recv[2] if len(recv) > 2 else []
+
+            self.cache_answers(new_questions, recv_answers, now)
         else:
             recv_header = new_header
             # QR = 0 for queries, QR = 1 for responses
             recv_header.qr = 1
-            recv_questions = new_questions
             recv_answers = []
 
         # Disable the recursion flag for cached or blocked queries
         # I'm not sure how much this actually works
         # https://serverfault.com/a/729121
-        if len(question_index_cached) > 0 or len(question_index_blocked) > 0:
+        if len(new_questions) < len(questions):
             recv_header.rd = 0
             recv_header.ra = 0
 
-        # Add the cached questions to the response, keeping the position
-        for idx in question_index_cached:
-            question = questions[idx]
-            recv_questions.insert(idx, question)
-            recv_answers.insert(idx, self.cache.get(question))
-            # Update question answer for header
-
-        # Add the blocked questions to the response, keeping the position
-        for idx in question_index_blocked:
-            question = questions[idx]
-            # Fake answer
-            answer = DNSAnswer(
-                decoded_name=question.decoded_name,
-                type_=question.type_,
-                class_=question.type_,
-                ttl=self.default_blocking_ttl,
-                rdlength=4,
-                # inet_aton encodes a ip address into bytes
-                rdata=socket.inet_aton(self.redirect_ip),
-            )
-
-            # Insert the questions and answer to the correct spot
-            recv_questions.insert(idx, question)
-            recv_answers.insert(idx, answer)
+        # Add the cached and blocked answers to the response, keeping the position
+        recv_answers_iter = iter(recv_answers)
+        answers = []
+        for answer in local_answers:
+            if answer is None:
+                # Sometimes the resolver doesn't answer every question
+                answer = next(recv_answers_iter, None)
+                if answer is None:
+                    continue
+            answers.append(answer)
+        # Keep any extra answers from the resolver
+        answers.extend(recv_answers_iter)
 
         # Update the header's question and answer count
-        recv_header.qdcount = len(recv_questions)
-        recv_header.ancount = len(recv_answers)
-
-        logging.debug(
-            f"Sending query back, {recv_header}, {recv_questions}, {recv_answers}"
-        )
+        recv_header.qdcount = len(questions)
+        recv_header.ancount = len(answers)
 
-        # Since we have a new response, cache it, using the original question and new answer
-        for cache_question, cache_answer in zip(questions, recv_answers):
-            # if cache_questio
-            # self.cache[cache_question]
-            if cache_question not in self.cache:
-                self.cache.set(cache_question, cache_answer, cache_answer.ttl)
+        logging.debug("Sending query back, %s, %s, %s", recv_header, questions, answers)
 
         # Pack and compress header, questions, answers
-        return pack_all_compressed(recv_header, recv_questions, recv_answers)
+        return pack_all_compressed(recv_header, questions, answers)
+
+    def servfail(self, header: DNSHeader, questions: list[DNSQuestion]) -> bytes:
+        """Create a SERVFAIL response to a query
+
+        :param header: header of the query
+        :type header: DNSHeader
+        :param questions: questions of the query
+        :type questions: list[DNSQuestion]
+        :return: packed response
+        :rtype: bytes
+        """
+        response_header = DNSHeader(id=header.id, flags=header.flags)
+        # QR = 1 for responses
+        response_header.qr = 1
+        response_header.ra = 1
+        # RCODE = 2 for server failure
+        # https://datatracker.ietf.org/doc/html/rfc1035#section-4.1.1
+        response_header.rcode = 2
+        response_header.qdcount = len(questions)
+        return pack_all_compressed(response_header, questions)
+
+    def cache_answers(
+        self, questions: list[DNSQuestion], answers: list[DNSAnswer], now: float
+    ):
+        """Cache the answers to forwarded questions
+
+        Only forwarded questions are cached, so cached answers don't get their
+        expiry refreshed. Answers are matched to questions by name, type and class,
+        since the resolver can return more than one answer per question (eg a CNAME
+        followed by the record it points to). Questions without a matching answer
+        aren't cached.
+
+        :param questions: questions that were forwarded
+        :type questions: list[DNSQuestion]
+        :param answers: answers from the resolver
+        :type answers: list[DNSAnswer]
+        :param now: current time
+        :type now: float
+        """
+        # (name, type, class) : first answer
+        matched = {}
+        for answer in answers:
+            key = (answer.decoded_name, answer.type_, answer.class_)
+            matched.setdefault(key, answer)
+
+        # Since we have a new response, cache it, using the original question and
+        # new answer
+        for question in questions:
+            key = (question.decoded_name, question.type_, question.class_)
+            answer = matched.get(key)
+            if answer is not None:
+                self.cache.set(question, answer, answer.ttl, now)
 
     def forward_dns_query(self, query: bytes) -> bytes:
         """Forward a DNS query to an address
 
         :param query: query to forward
         :type query: bytes
-        :param addr: tuple containing address and port
-        :type addr: tuple[str, int]
+        :raises TimeoutError: the resolver didn't respond in time
         :return: response from the server
         :rtype: bytes
         """
 
-        self.resolver_socket.sendto(query, self.resolver_socket_addr)
-
-        response, _ = self.resolver_socket.recvfrom(512)
-        return response
+        response_queue = queue.Queue(maxsize=1)
+        # Give the query a transaction ID that isn't being used
+        with self.pending_lock:
+            tid = secrets.randbits(16)
+            while tid in self.pending:
+                tid = secrets.randbits(16)
+            self.pending[tid] = response_queue
+
+        try:
+            self.resolver_socket.send(_U16.pack(tid) + query[2:])
+            response = response_queue.get(timeout=self.resolver_timeout)
+        except queue.Empty:
+            raise TimeoutError("Resolver didn't respond") from None
+        finally:
+            with self.pending_lock:
+                self.pending.pop(tid, None)
+
+        # Restore the original transaction ID
+        return query[:2] + response[2:]
+
+    def receive_resolver_responses(self):
+        """Receive responses from the resolver, until the socket is closed"""
+        # Receive every response into the same buffer
+        # Queries are forwarded with the client's EDNS payload size, so responses
+        # can be larger than 512 bytes
+        buf = bytearray(65535)
+        view = memoryview(buf)
+        while True:
+            try:
+                nbytes = self.resolver_socket.recv_into(buf)
+            except OSError:
+                # Socket was closed
+                if self.resolver_socket.fileno() == -1:
+                    return
+                # Otherwise keep receiving (eg ICMP port unreachable from resolver)
+                logging.error("Error receiving from resolver", exc_info=1)
+                continue
+            # Too short to have a header
+            if nbytes < _HDR.size:
+                continue
+
+            with self.pending_lock:
+                response_queue = self.pending.pop(_U16.unpack_from(buf, 0)[0], None)
+            # The query might have timed out already
+            if response_queue is not None:
+                response_queue.put(bytes(view[:nbytes]))
 
     def done(self):
         """Close sockets"""
-        self.sock.close()
-        self.resolver_socket.close()
-
-    def threaded_handle_dns_query(self, addr, lock, *args, **kwargs):
-        """Run a threaded version of handle_dns_query
+        for sock in self.socks:
+            sock.close()
+        if self.resolver_socket.fileno() != -1:
+            # Closing doesn't wake a thread blocked receiving, but shutting down does
+            self.resolver_socket.shutdown(socket.SHUT_RDWR)
+            self.resolver_socket.close()
+        self.resolver_thread.join()
+
+    def serve_forever(
+        self, sock: socket.socket, executor: concurrent.futures.Executor
+    ):
+        """Run an event loop serving a socket, in the current thread
 
-        :param addr: address + port of client
-        :type addr: tuple[str, int]
+        :param sock: socket to serve
+        :type sock: socket.socket
+        :param executor: executor to handle queries on
+        :type executor: concurrent.futures.Executor
         """
-        response = self.handle_dns_query(*args, **kwargs)
-        with lock:
-            self.sock.sendto(response, addr)
-        # self.sock.sendto(self.handle_dns_query(*args, **kwargs), addr)
-        logging.info("Sent response")
-
-    def start_threaded(self):
-        """Start a threaded server"""
-        logging.info(f"Threaded DNS Server running at {host[0]}:{host[1]}")
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(
+            loop.create_datagram_endpoint(
+                lambda: DNSProtocol(self, executor), sock=sock
+            )
+        )
+        loop.run_forever()
 
-        # Lock sockets send back
-        lock = threading.Lock()
+    def start_threaded(self, max_workers: int = 10):
+        """Start a threaded server
 
-        with concurrent.futures.ThreadPoolExecutor(max_workers=10) as executor:
-            while True:
-                try:
-                    # Recieve packet
-                    buf, addr = self.sock.recvfrom(512)
+        On Linux, each CPU gets its own socket and event loop, so sends don't
+        contend on a lock. Queries are handled on a shared thread pool.
 
-                    executor.submit(self.threaded_handle_dns_query, addr, lock, buf)
-                except Exception as e:
-                    # Handle errors, but keep the program running
-                    self.done()
-                    logging.error("Error", exc_info=1)
+        :param max_workers: number of threads to handle queries, defaults to 10
+        :type max_workers: int
+        """
+        logging.info(f"Threaded DNS Server running at {self.host[0]}:{self.host[1]}")
+
+        # SO_REUSEPORT only load balances UDP on Linux (on macOS/BSD the newest
+        # socket gets every datagram), so use a single socket everywhere else
+        reuse_port = sys.platform.startswith("linux")
+        shards = (os.cpu_count() or 1) if reuse_port else 1
+        self.socks = [self.make_server_socket(reuse_port) for _ in range(shards)]
+        self.sock = self.socks[0]
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            threads = [
+                threading.Thread(
+                    target=self.serve_forever, args=(sock, executor), daemon=True
+                )
+                for sock in self.socks
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
 
     def start(self):
         """Start a non-threaded server"""
-        logging.info(f"DNS Server running at {host[0]}:{host[1]}")
+        logging.info(f"DNS Server running at {self.host[0]}:{self.host[1]}")
+
+        self.sock = self.make_server_socket()
+        self.socks = [self.sock]
+
+        # Receive every packet into the same buffer
+        buf = bytearray(512)
+        view = memoryview(buf)
         while True:
             try:
-                buf, addr = self.sock.recvfrom(512)
-                response = self.handle_dns_query(buf)
+                nbytes, addr = self.sock.recvfrom_into(buf)
+                response = self.handle_dns_query(view[:nbytes])
                 self.sock.sendto(response, addr)
                 logging.info("Sent response")
             except Exception as e:
@@ -702,7 +1106,17 @@ if __name__ == "__main__":
     parser.add_argument(
         "--loglevel",
         "-l",
-        choices=list(logging.getLevelNamesMapping().keys()),
+        # logging.getLevelNamesMapping() is only in Python 3.11+ (not in PyPy 3.10)
+        choices=[
+            "CRITICAL",
+            "FATAL",
+            "ERROR",
+            "WARN",
+            "WARNING",
+            "INFO",
+            "DEBUG",
+            "NOTSET",
+        ],
         default="INFO",
         type=str,
         help="Provide information about the logging level (default = info)",